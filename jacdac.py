@@ -10,6 +10,8 @@ JD_FRAME_FLAG_ACK_REQUESTED = 0x02
 JD_FRAME_FLAG_IDENTIFIER_IS_SERVICE_CLASS = 0x04
 
 JD_PACKET_HEADER_SIZE = 4
+JD_DEVICE_TIMEOUT = 2500 # ms, five missed advertisements
+JD_TX_QUEUE_SIZE = 16 # frames, the queue is flushed when it fills up
 REG_INTENSITY = 0x01
 
 REG_VALUE = 0x02
@@ -41,6 +43,26 @@ REG_CTRL_MICROS_SINCE_BOOT = 0x186
 
 jacdac_instance = None
 
+# supervisor.ticks_ms() wraps around every 2**29 milliseconds
+TICKS_PERIOD = 1 << 29
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALFPERIOD = TICKS_PERIOD // 2
+
+try:
+    from supervisor import ticks_ms
+except ImportError:
+    # older CircuitPython builds (such as samples/JD_CPY_CLUE.uf2) have no
+    # supervisor.ticks_ms(), monotonic_ns() keeps the timestamps integer there
+    def ticks_ms():
+        return (time.monotonic_ns() // 1000000) & TICKS_MAX
+
+####
+# milliseconds elapsed from t2 to t1, correct across ticks_ms() wraparound
+####
+def ticks_diff(t1, t2):
+    diff = (t1 - t2) & TICKS_MAX
+    return ((diff + TICKS_HALFPERIOD) & TICKS_MAX) - TICKS_HALFPERIOD
+
 class JDHeader:
     data = None
     crc = 0
@@ -49,15 +71,21 @@ class JDHeader:
     device_id = 0
 
     def __init__(self, buf):
+        if buf is not None:
+            self.parse(buf)
+
+    def parse(self, buf):
         self.data = buf
-        if self.data is not None:
-            self.crc, self.size, self.flags, self.device_id = struct.unpack_from('<HBBQ', self.data, 0)
+        self.crc, self.size, self.flags, self.device_id = struct.unpack_from('<HBBQ', buf, 0)
 
     def serialize(self):
-        b = bytearray(12)
-        struct.pack_into('<HBBQ', b, 0, 0, self.size, self.flags, self.device_id) # blank crc, computed by phys
+        b = bytearray(JD_FRAME_HEADER_SIZE)
+        self.serialize_into(b)
         return b
 
+    def serialize_into(self, buf):
+        struct.pack_into('<HBBQ', buf, 0, 0, self.size, self.flags, self.device_id) # blank crc, computed by phys
+
 
 class JDPacket:
     header = None
@@ -73,17 +101,25 @@ class JDPacket:
             self.header = JDHeader(None)
 
         if data is not None:
-            upack = struct.unpack_from('<BBH', data, 0)
-            self.size = upack[0]
-            self.service_index = upack[1]
-            self.service_command = upack[2]
+            self.parse(data)
+
+    def parse(self, data):
+        upack = struct.unpack_from('<BBH', data, 0)
+        self.size = upack[0]
+        self.service_index = upack[1]
+        self.service_command = upack[2]
+        # process() passes a view into the receive buffer, which can be sliced
+        # without wrapping it in another memoryview
+        if isinstance(data, memoryview):
             self.data = data[4:]
+        else:
+            self.data = memoryview(data)[4:]
 
     def is_reg_set(self):
-        return (self.service_command >> 12) == (CMD_SET_REG >> 12)
+        return (self.service_command & CMD_TYPE_MASK) == CMD_SET_REG
 
     def is_reg_get(self):
-        return (self.service_command >> 12) == (CMD_GET_REG >> 12)
+        return (self.service_command & CMD_TYPE_MASK) == CMD_GET_REG
 
     def is_command(self):
         if self.data is None:
@@ -98,9 +134,14 @@ class JDPacket:
         return (self.header.flags & JD_FRAME_FLAG_COMMAND) == 0
 
     def serialize(self):
-        b = bytearray(4)
-        struct.pack_into('<BBH', b, 0, len(self.data), self.service_index, self.service_command)
-        return self.header.serialize() + b + self.data
+        # the whole frame is written into one buffer rather than joining
+        # separately serialized header, packet header and data
+        n = len(self.data)
+        b = bytearray(JD_FRAME_HEADER_SIZE + JD_PACKET_HEADER_SIZE + n)
+        self.header.serialize_into(b)
+        struct.pack_into('<BBH', b, JD_FRAME_HEADER_SIZE, n, self.service_index, self.service_command)
+        b[JD_FRAME_HEADER_SIZE + JD_PACKET_HEADER_SIZE:] = self.data
+        return b
 
 
 class JDServiceHost:
@@ -110,7 +151,7 @@ class JDServiceHost:
     stack = None
     def __init__(self, service_class, stack):
         self.service_class = service_class
-        self.time = time.monotonic()
+        self.time = ticks_ms()
         self.stack = stack
 
     def handle_packet(self, p):
@@ -123,7 +164,7 @@ class JDServiceHost:
         return
 
     def handle_command(self, p):
-        if p.is_reg_set():
+        if (p.service_command & CMD_TYPE_MASK) == CMD_SET_REG:
             self.handle_register_set(p)
         else:
             self.handle_register_get(p)
@@ -147,139 +188,169 @@ class JDServiceHost:
 
 class JDControl(JDServiceHost):
     stack = None
+    adv = None
+    device_class = struct.pack("<I", 0xAAAAAAAA)
+    device_description = b"Generic CircuitPython device"
+    firmware_version = b"v0.0.1"
     def __init__(self, stack):
         super().__init__(0, stack) # control is service class 0
+        self.service_index = 0
 
     def handle_command(self, p):
-        cmd = p.service_command & CMD_VAL_MASK
-        resp = JDPacket(None, None)
-        resp.service_index = 0
-
-        if cmd == CMD_CTRL_RESET:
-            supervisor.reload()
-        elif cmd == REG_CTRL_DEVICE_DESCRIPTION:
-            resp.service_command = CMD_GET_REG | REG_CTRL_DEVICE_DESCRIPTION
-            resp.data = bytearray("Generic CircuitPython device")
-            self.stack.send(resp)
-        elif cmd == REG_CTRL_DEVICE_CLASS:
-            resp.service_command = CMD_GET_REG | REG_CTRL_DEVICE_CLASS
-            resp.data = bytearray(4)
-            struct.pack_into("<I", resp.data, 0, 0xAAAAAAAA)
-            self.stack.send(resp)
-        elif cmd == REG_CTRL_FIRMWARE_VERSION:
-            resp.service_command = CMD_GET_REG | REG_CTRL_FIRMWARE_VERSION
-            resp.data = bytearray("v0.0.1")
-            self.stack.send(resp)
+        name = self.command_handlers.get(p.service_command & CMD_VAL_MASK)
+        if name is not None:
+            getattr(self, name)(p)
+
+    def handle_reset(self, p):
+        supervisor.reload()
+
+    def handle_device_description(self, p):
+        self.send_report(CMD_GET_REG | REG_CTRL_DEVICE_DESCRIPTION, self.device_description)
+
+    def handle_device_class(self, p):
+        self.send_report(CMD_GET_REG | REG_CTRL_DEVICE_CLASS, self.device_class)
+
+    def handle_firmware_version(self, p):
+        self.send_report(CMD_GET_REG | REG_CTRL_FIRMWARE_VERSION, self.firmware_version)
+
+    # command/register code -> handler method name, looked up on the instance
+    # so subclasses can override individual handlers
+    command_handlers = {
+        CMD_CTRL_RESET: "handle_reset",
+        REG_CTRL_DEVICE_DESCRIPTION: "handle_device_description",
+        REG_CTRL_DEVICE_CLASS: "handle_device_class",
+        REG_CTRL_FIRMWARE_VERSION: "handle_firmware_version",
+    }
 
     def tick(self, now):
-        if now - self.time < .5:
+        if ticks_diff(now, self.time) < 500:
             return
 
         self.time = now
 
-        adv = JDPacket(None, None)
-        adv.service_index = 0
-        adv.service_command = 0
-        adv.data = bytearray(len(self.stack.services) * 4)
+        # the advertisement only changes when services are added, so it is
+        # built once and resent as is
+        if self.adv is None:
+            adv = JDPacket(None, None)
+            adv.service_index = 0
+            adv.service_command = 0
+            n = len(self.stack.services)
+            adv.data = bytearray(n * 4)
+            struct.pack_into('<%dI' % n, adv.data, 0, *[s.service_class for s in self.stack.services])
 
-        i = 0
-        for s in self.stack.services:
-            struct.pack_into('<I', adv.data, i, s.service_class)
-            i += 4
+            self.adv = adv
 
-        self.stack.send(adv)
+        self.stack.send(self.adv)
 
 class JDDevice:
     last_packet = None
-    ticks = 5
     service_classes = None
     device_id = None
     short_id = None
-    time = 0
+    time = None # last advertisement, None for the local device
 
     def __init__(self, packet, short_id):
         if packet is not None:
             self.device_id = packet.header.device_id
             self.short_id = short_id
             self.update(packet)
-            self.time = time.monotonic()
 
     def update(self, packet):
-        self.ticks = 5
-        self.service_classes = struct.unpack_from('<' + ("I" * int(packet.size/4)), packet.data, 0)
+        self.time = ticks_ms()
+        self.service_classes = struct.unpack_from('<%dI' % (packet.size >> 2), packet.data, 0)
 
+    ####
+    # returns True once the device has stopped advertising
+    ####
     def tick(self, t):
-        if self.time == 0:
+        if self.time is None:
             return False
 
-        if t - self.time >= .5:
-            self.ticks -= 1
-
-        return self.ticks == 0
+        return ticks_diff(t, self.time) >= JD_DEVICE_TIMEOUT
 
 class JDSensor(JDServiceHost):
     streaming = -1
-    streaming_interval = .1
+    _streaming_interval_ms = 100
+    samples_buf = None
+    interval_buf = None
 
     def __init__(self, service_class, stack):
         super().__init__(service_class, stack)
+        # reused for every register reply from this sensor
+        self.samples_buf = bytearray(1)
+        self.interval_buf = bytearray(4)
+
+    ####
+    # streaming interval in seconds, kept internally in milliseconds
+    ####
+    @property
+    def streaming_interval(self):
+        return self._streaming_interval_ms / 1000
+
+    @streaming_interval.setter
+    def streaming_interval(self, value):
+        self._streaming_interval_ms = int(value * 1000)
 
     def tick(self, now):
-        if self.streaming >= 0 and (now - self.time) >= self.streaming_interval:
+        if self.streaming >= 0 and ticks_diff(now, self.time) >= self._streaming_interval_ms:
             self.time = now
             self.streaming -= 1
-            self.__sensor_report()
+            self.sensor_report()
+
+    def sensor_report(self):
+        return
 
     def handle_register_set(self, p):
         cmd = p.service_command & CMD_VAL_MASK
         if cmd == REG_STREAMING_SAMPLES:
             self.streaming = struct.unpack_from('<B',p.data, 0)[0]
         if cmd == REG_STREAMING_INTERVAL:
-            self.streaming_interval = float(struct.unpack_from('<I',p.data, 0)[0]) / 1000
+            self._streaming_interval_ms = struct.unpack_from('<I',p.data, 0)[0]
 
     def handle_register_get(self, p):
         cmd = p.service_command & CMD_VAL_MASK
         if cmd == REG_STREAMING_SAMPLES:
-            b = bytearray(1)
-            val = 0
-            if self.streaming > 0:
-                val = self.streaming
-            struct.pack_into('<B', b, 0, val)
+            b = self.samples_buf
+            b[0] = self.streaming if self.streaming > 0 else 0
             self.send_report(CMD_GET_REG | REG_STREAMING_SAMPLES, b)
 
         if cmd == REG_STREAMING_INTERVAL:
-            resp = JDPacket(None, None)
-            b = bytearray(4)
-            struct.pack_into('<I', b, 0, int(self.streaming_interval * 1000))
+            b = self.interval_buf
+            struct.pack_into('<I', b, 0, self._streaming_interval_ms)
             self.send_report(CMD_GET_REG | REG_STREAMING_INTERVAL, b)
 
 
 class JDAccelerometer(JDSensor):
     accelerometer = None
+    reading_buf = None
     def __init__(self, accelerometer, stack):
         super().__init__(0x1f140409, stack)
         self.accelerometer = accelerometer
+        self.reading_buf = bytearray(6) # 3 sixteen bit samples
 
-    def __sensor_report(self):
-        p = JDPacket(None, None)
-        b = bytearray(6) # 3 sixteen bit samples
+    def sensor_report(self):
         raw = self.accelerometer._raw_accel_data
-        struct.pack_into('<hhh', b, 0, raw[0], raw[1], raw[2])
-        self.send_report(CMD_GET_REG | REG_READING, b)
+        struct.pack_into('<hhh', self.reading_buf, 0, raw[0], raw[1], raw[2])
+        self.send_report(CMD_GET_REG | REG_READING, self.reading_buf)
 
     def handle_register_get(self, p):
         super().handle_register_get(p)
         cmd = p.service_command & CMD_VAL_MASK
         if cmd == 0x101:
-            self.__sensor_report()
+            self.sensor_report()
 
 class JDStack:
     bus = None
     dev = None
     ctrl = None
     buf = bytearray(256)
+    rx_view = None
+    rx_header = None
+    rx_packet = None
     services = []
     devices = []
+    devices_by_id = None
+    tx_queue = None
     udid = 0
 
     def __init__(self, pin):
@@ -291,9 +362,20 @@ class JDStack:
         self.dev = JDDevice(None, None)
         self.dev.device_id = struct.unpack_from('<Q',microcontroller.cpu.uid,0)[0]
         self.dev.short_id = self.bus.hash(microcontroller.cpu.uid).decode()
-        self.dev.ticks = -1
 
-        self.devices += [self.dev]
+        self.devices = [self.dev]
+        self.devices_by_id = {self.dev.device_id: self.dev}
+
+        # received packets are dispatched as soon as they are parsed, so a
+        # single header/packet pair is reused for every incoming frame and
+        # packet data is a view into buf (handlers must copy what they keep)
+        self.rx_view = memoryview(self.buf)
+        self.rx_header = JDHeader(None)
+        self.rx_packet = JDPacket(self.rx_header, None)
+
+        # outgoing frames are serialized when queued and written to the bus by
+        # flush(), so handling received packets never waits on a transmission
+        self.tx_queue = []
 
     ####
     # send a packet without any modifications by the stack
@@ -304,7 +386,7 @@ class JDStack:
         else:
             packet.header.device_id = self.dev.device_id
         packet.header.size = len(packet.data) + JD_PACKET_HEADER_SIZE
-        self.bus.send(packet.serialize())
+        self.queue(packet.serialize())
 
     ####
     # send a command packet
@@ -316,7 +398,7 @@ class JDStack:
             packet.header.device_id = self.dev.device_id
         packet.header.flags |= JD_FRAME_FLAG_COMMAND
         packet.header.size = len(packet.data) + JD_PACKET_HEADER_SIZE
-        self.bus.send(packet.serialize())
+        self.queue(packet.serialize())
 
     ####
     # send a report packet
@@ -327,50 +409,83 @@ class JDStack:
         else:
             packet.header.device_id = self.dev.device_id
         packet.header.size = len(packet.data) + JD_PACKET_HEADER_SIZE
-        self.bus.send(packet.serialize())
+        self.queue(packet.serialize())
+
+    ####
+    # queue a serialized frame, transmitting the queue first when it is full
+    ####
+    def queue(self, frame):
+        if len(self.tx_queue) >= JD_TX_QUEUE_SIZE:
+            self.flush()
+        self.tx_queue.append(frame)
+
+    ####
+    # transmit all queued frames
+    ####
+    def flush(self):
+        # swap the queue out first so a failing send drops its frame instead
+        # of resending the frames before it on every later flush
+        q = self.tx_queue
+        self.tx_queue = []
+        send = self.bus.send
+        for frame in q:
+            send(frame)
 
     def add_service(self, service):
         #todo: in future we may want to have differentiation between client/host services
         self.services += [service]
         service.service_index = len(self.services) - 1
+        self.ctrl.adv = None
 
-    def process(self):
-        p = self.bus.receive(self.buf)
-
-        packets = []
-
-        while p:
-            header = JDHeader(self.buf[:JD_FRAME_HEADER_SIZE])
-            i = JD_FRAME_HEADER_SIZE
+    def handle_packet(self, p):
+        device_id = p.header.device_id
+        service_index = p.service_index
+
+        if device_id == self.dev.device_id and service_index < len(self.services):
+            self.services[service_index].handle_packet(p)
+        elif service_index == 0 and p.service_command == CMD_ADVERTISEMENT_DATA:
+            found = self.devices_by_id.get(device_id)
+            if found is None:
+                d = JDDevice(p, self.bus.hash(memoryview(p.header.data)[4:12]).decode())
+                self.devices += [d]
+                self.devices_by_id[device_id] = d
+            else:
+                found.update(p)
 
-            while i < JD_FRAME_HEADER_SIZE + header.size:
+    def process(self):
+        header = self.rx_header
+        p = self.rx_packet
+        buf = self.buf
+        view = self.rx_view
+        receive = self.bus.receive
+        handle_packet = self.handle_packet
+        frame_header_size = JD_FRAME_HEADER_SIZE
+        packet_header_size = JD_PACKET_HEADER_SIZE
 
-                size = struct.unpack_from('B', self.buf, i)[0]
-                packets += [JDPacket(header, bytearray(self.buf[i: i + size + JD_PACKET_HEADER_SIZE]))]
-                i += size + JD_PACKET_HEADER_SIZE
+        while receive(buf):
+            header.parse(buf)
+            i = frame_header_size
+            end = frame_header_size + header.size
 
-            p = self.bus.receive(self.buf)
+            while i < end:
 
-        for p in packets:
-            if p.header.device_id == self.dev.device_id and p.service_index < len(self.services):
-                self.services[p.service_index].handle_packet(p)
-            elif p.service_index == 0 and p.service_command == CMD_ADVERTISEMENT_DATA:
-                found = None
-                for d in self.devices:
-                    if d.device_id == p.header.device_id:
-                        found = d
-                        break
-                if found is None:
-                    self.devices += [JDDevice(p, self.bus.hash(p.header.data[4:12]).decode())]
-                else:
-                    found.update(p)
+                size = buf[i]
+                p.parse(view[i: i + size + packet_header_size])
+                handle_packet(p)
+                i += size + packet_header_size
 
-        now = time.monotonic()
+        now = ticks_ms()
 
         for s in self.services:
             s.tick(now)
 
-        for d in self.devices:
+        # walk backwards so removing an expired device doesn't skip the next one
+        devices = self.devices
+        for i in range(len(devices) - 1, -1, -1):
+            d = devices[i]
             if d.tick(now):
-                self.devices.remove(d)
+                del devices[i]
+                del self.devices_by_id[d.device_id]
+
+        self.flush()
 